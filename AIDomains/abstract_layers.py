@@ -229,10 +229,15 @@ class ReLU(nn.ReLU, AbstractModule):
         super(ReLU, self).__init__()
         self.deepz_lambda = None
         self.relu_shrinkage:Optional[float] = None
+        self.dp_relu_cache = {}
 
     def get_neurons(self) -> int:
         return reduce(lambda a, b: a * b, self.dim)
 
+    def reset_bounds(self):
+        self.bounds = None
+        self.dp_relu_cache = {}
+
     def forward(self, x) -> Union[AbstractElement,Tensor]:
         if isinstance(x, AbstractElement):
             out, deepz_lambda = x.relu(self.deepz_lambda, self.bounds, self.relu_shrinkage)
@@ -1,14 +1,98 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
-from typing import Optional, List, Tuple, Union
+from math import prod
+from typing import Callable, Optional, List, Tuple, Union
 from torch import Tensor
 
 from AIDomains.abstract_layers import Normalization, Linear, ReLU, Conv2d, Flatten, GlobalAvgPool2d, AvgPool2d, Upsample, _BatchNorm, Bias, Scale, ResBlock, Sequential
 from AIDomains.zonotope import HybridZonotope
 
-from .ai_util import get_neg_pos_comp
+
+@torch.jit.script
+def _relu_relaxation(x_lb: Tensor, x_ub: Tensor, dp_lambda: Optional[Tensor]) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:
+    '''
+    Sparse encoding of the DeepPoly ReLU relaxation: stably active neurons have both slopes 1 and stably inactive ones 0,
+    so only the mask of stably active neurons is stored densely. Slopes and upper intercept are stored for the remaining
+    neurons (flattened neuron indices idx, unstable for some input of the batch), unsqueezed to broadcast against the coefficients.
+    The lower bound always passes through the origin.
+    '''
+    stably_inactive = x_ub < 0
+    stably_active = x_lb > 0
+    crossing = (x_lb < 0) & (x_ub > 0)
+    zeros = torch.zeros_like(x_lb)
+    ones = torch.ones_like(x_lb)
+    denom = x_ub - x_lb + 1e-15
+
+    # original DP; DP-0 would use x_lb < 0 instead
+    if dp_lambda is None:
+        lambda_l = torch.where(x_ub < -x_lb, zeros, ones)
+    else:
+        lambda_l = dp_lambda.view(x_lb.shape)
+    lambda_l = torch.where(stably_active, ones, torch.where(stably_inactive, zeros, lambda_l))
+    lambda_u = torch.where(stably_active, ones, torch.where(stably_inactive, zeros, x_ub / denom))
+    # height of upper bound intersection with y axis
+    mu_u = torch.where(crossing, -x_ub * x_lb / denom, zeros)
+
+    idx = (~(stably_active | stably_inactive)).flatten(1).any(0).nonzero().squeeze(1)
+    lambda_l = lambda_l.flatten(1).index_select(1, idx)
+    lambda_u = lambda_u.flatten(1).index_select(1, idx)
+    mu_u = mu_u.flatten(1).index_select(1, idx)
+
+    return stably_active.to(x_lb.dtype).unsqueeze(1), idx, lambda_l.unsqueeze(1), lambda_u.unsqueeze(1), mu_u.unsqueeze(1)
+
+
+@torch.jit.script
+def _relu_fuse(coef_l: Tensor, coef_u: Tensor, active: Tensor, idx: Tensor, lambda_l: Tensor, lambda_u: Tensor, mu_u: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    '''
+    Backsubstitute the DeepPoly ReLU relaxation through the coefficients in a single scripted op.
+    Stable neurons only need the active mask; for the others (idx), positive coefficients take the lower relaxation for
+    x_l_coef (upper for x_u_coef) and negative ones the other, which is done by selecting the slope per entry instead of
+    materializing the positive/negative split.
+    '''
+    x_l_coef = coef_l * active
+    x_u_coef = coef_u * active
+    if idx.numel() == 0:
+        return x_l_coef, x_u_coef, torch.zeros_like(mu_u).sum(), torch.zeros_like(mu_u).sum()
+
+    coef_l = coef_l.flatten(2).index_select(2, idx)
+    coef_u = coef_u.flatten(2).index_select(2, idx)
+    # the products are fresh tensors, so the unstable entries can be written in place
+    x_l_coef = x_l_coef.flatten(2).index_copy_(2, idx, coef_l * torch.where(coef_l >= 0, lambda_l, lambda_u)).reshape(x_l_coef.shape)
+    x_u_coef = x_u_coef.flatten(2).index_copy_(2, idx, coef_u * torch.where(coef_u >= 0, lambda_u, lambda_l)).reshape(x_u_coef.shape)
+    new_x_l_bias = (coef_l * torch.where(coef_l < 0, mu_u, torch.zeros_like(mu_u))).sum(2)
+    new_x_u_bias = (coef_u * torch.where(coef_u >= 0, mu_u, torch.zeros_like(mu_u))).sum(2)
+    return x_l_coef, x_u_coef, new_x_l_bias, new_x_u_bias
+
+
+def _linear_backsub(x_coef: Tensor, x_bias: Tensor, weight: Tensor, bias: Optional[Tensor]) -> Tuple[Tensor, Tensor]:
+    if bias is None:
+        return x_coef.matmul(weight), x_bias
+    return x_coef.matmul(weight), x_bias + x_coef.matmul(bias)
+
+
+def _bias_backsub(x_coef: Tensor, x_bias: Tensor, bias: Tensor) -> Tuple[Tensor, Tensor]:
+    view_dim = (1, 1) + (bias.shape)
+    return x_coef, x_bias + (x_coef*bias.view(view_dim)).flatten(2).sum(2)
+
+
+def _scale_backsub(x_coef: Tensor, x_bias: Tensor, scale: Tensor) -> Tuple[Tensor, Tensor]:
+    view_dim = (1, 1) + (scale.shape)
+    return x_coef*scale.view(view_dim), x_bias
+
+
+# shared initial bias; DeepPoly operations are out-of-place, so it is never modified and broadcasts as a scalar on any device
+_ZERO = torch.tensor(0)
+# side CUDA streams used for independent branches, keyed by device
+_SIDE_STREAMS = {}
+# weights of the average pooling kernels, keyed by (dtype, device, channels, kernel_size)
+_AVG_POOL_WEIGHTS = {}
+
+
+def _get_side_stream(device: torch.device) -> "torch.cuda.Stream":
+    if device not in _SIDE_STREAMS:
+        _SIDE_STREAMS[device] = torch.cuda.Stream(device)
+    return _SIDE_STREAMS[device]
 
 
 class DeepPoly:
@@ -24,8 +108,8 @@ class DeepPoly:
 
         self.x_l_coef = expr_coef if x_l_coef is None else x_l_coef
         self.x_u_coef = expr_coef if x_u_coef is None else x_u_coef
-        self.x_l_bias = torch.tensor(0) if x_l_bias is None else x_l_bias
-        self.x_u_bias = torch.tensor(0) if x_u_bias is None else x_u_bias
+        self.x_l_bias = _ZERO if x_l_bias is None else x_l_bias
+        self.x_u_bias = _ZERO if x_u_bias is None else x_u_bias
 
     def clone(self) -> "DeepPoly":
         return DeepPoly(self.x_l_coef.clone(), self.x_u_coef.clone(), self.x_l_bias.clone(), self.x_u_bias.clone())
@@ -37,27 +121,30 @@ class DeepPoly:
         x_u_bias = self.x_u_bias.detach()
         return DeepPoly(x_l_coef, x_u_coef, x_l_bias, x_u_bias)
 
-    def dp_linear(self, weight: Tensor, bias: Tensor) -> "DeepPoly":
-        x_l_bias = self.x_l_bias + (0 if bias is None else self.x_l_coef.matmul(bias))
-        x_u_bias = self.x_u_bias + (0 if bias is None else self.x_u_coef.matmul(bias))
-
-        x_l_coef = self.x_l_coef.matmul(weight)
-        x_u_coef = self.x_u_coef.matmul(weight)
+    def is_aliased(self) -> bool:
+        '''
+        Lower and upper expression are the same objects until the first relu splits them.
+        '''
+        return self.x_l_coef is self.x_u_coef and self.x_l_bias is self.x_u_bias
 
+    def _backsub(self, op: Callable[[Tensor, Tensor], Tuple[Tensor, Tensor]]) -> "DeepPoly":
+        '''
+        Apply op to the lower and the upper (coef, bias) pair; for aliased expressions op is applied once and the result stays aliased.
+        '''
+        x_l_coef, x_l_bias = op(self.x_l_coef, self.x_l_bias)
+        if self.is_aliased():
+            return DeepPoly(x_l_coef, x_l_coef, x_l_bias, x_l_bias)
+        x_u_coef, x_u_bias = op(self.x_u_coef, self.x_u_bias)
         return DeepPoly(x_l_coef, x_u_coef, x_l_bias, x_u_bias)
 
-    def dp_bias(self, bias: Tensor) -> "DeepPoly":
-        view_dim = (1, 1) + (bias.shape)
+    def dp_linear(self, weight: Tensor, bias: Tensor) -> "DeepPoly":
+        return self._backsub(lambda x_coef, x_bias: _linear_backsub(x_coef, x_bias, weight, bias))
 
-        x_l_bias = self.x_l_bias + (self.x_l_coef*bias.view(view_dim)).sum(tuple(range(2-self.x_l_coef.dim(),0)))
-        x_u_bias = self.x_u_bias + (self.x_u_coef*bias.view(view_dim)).sum(tuple(range(2-self.x_l_coef.dim(),0)))
-        return DeepPoly(self.x_l_coef, self.x_u_coef, x_l_bias, x_u_bias)
+    def dp_bias(self, bias: Tensor) -> "DeepPoly":
+        return self._backsub(lambda x_coef, x_bias: _bias_backsub(x_coef, x_bias, bias))
 
     def dp_scale(self, scale: Tensor) -> "DeepPoly":
-        view_dim = (1, 1) + (scale.shape)
-        x_l_coef = self.x_l_coef*scale.view(view_dim)
-        x_u_coef = self.x_u_coef*scale.view(view_dim)
-        return DeepPoly(x_l_coef, x_u_coef, self.x_l_bias, self.x_u_bias)
+        return self._backsub(lambda x_coef, x_bias: _scale_backsub(x_coef, x_bias, scale))
 
     def dp_add(self, other: "DeepPoly") -> "DeepPoly":
         x_l_coef = self.x_l_coef + other.x_l_coef
@@ -68,14 +155,10 @@ class DeepPoly:
 
     def dp_global_avg_pool2d(self, preconv_wh: Union[Tensor, torch.Size]) -> "DeepPoly":
         sz = self.x_l_coef.shape
-        input_spatial_size = np.prod(preconv_wh[-2:])
-        dtype=self.x_l_coef.dtype
-        device=self.x_l_coef.device
-
-        x_l_coef = self.x_l_coef * torch.ones((1,1,1,*preconv_wh[-2:]), dtype=dtype, device=device)/input_spatial_size
-        x_u_coef = self.x_u_coef * torch.ones((1,1,1,*preconv_wh[-2:]), dtype=dtype, device=device)/input_spatial_size
+        input_spatial_size = prod(preconv_wh[-2:])
 
-        return DeepPoly(x_l_coef, x_u_coef, self.x_l_bias, self.x_u_bias)
+        # expand is a stride-0 view, so the coefficients are only materialized by the next layer
+        return self._backsub(lambda x_coef, x_bias: ((x_coef / input_spatial_size).expand(*sz[:3], *preconv_wh[-2:]), x_bias))
 
     def dp_avg_pool2d(self, preconv_wh: Union[Tensor, torch.Size], kernel_size: Union[Tuple[int,int],int],
                       stride: Union[Tuple[int,int],int], padding: Union[Tuple[int,int],int]) -> "DeepPoly":
@@ -94,73 +177,52 @@ class DeepPoly:
 
         sz = self.x_l_coef.shape
 
-        weight = 1/(np.prod(kernel_size)) * torch.ones((preconv_wh[0],1,*kernel_size), dtype=dtype, device=device)
+        key = (dtype, device, int(preconv_wh[0]), kernel_size)
+        if key not in _AVG_POOL_WEIGHTS:
+            _AVG_POOL_WEIGHTS[key] = 1/prod(kernel_size) * torch.ones((preconv_wh[0],1,*kernel_size), dtype=dtype, device=device)
+        weight = _AVG_POOL_WEIGHTS[key]
 
-        new_x_l_coef = F.conv_transpose2d(self.x_l_coef.view((sz[0] * sz[1], *sz[2:])), weight, None, stride, padding,
-                                           output_padding, preconv_wh[0], 1)
-        new_x_u_coef = F.conv_transpose2d(self.x_u_coef.view((sz[0] * sz[1], *sz[2:])), weight, None, stride, padding,
-                                           output_padding, preconv_wh[0], 1)
-        x_l_coef = new_x_l_coef.view((sz[0], sz[1], *new_x_l_coef.shape[1:]))
-        x_u_coef = new_x_u_coef.view((sz[0], sz[1], *new_x_u_coef.shape[1:]))
+        def backsub(x_coef, x_bias):
+            new_x_coef = F.conv_transpose2d(x_coef.view((sz[0] * sz[1], *sz[2:])), weight, None, stride, padding,
+                                            output_padding, preconv_wh[0], 1)
+            return new_x_coef.view((sz[0], sz[1], *new_x_coef.shape[1:])), x_bias
 
-        return DeepPoly(x_l_coef, x_u_coef, self.x_l_bias, self.x_u_bias)
+        return self._backsub(backsub)
 
     def dp_normalize(self, mean: Tensor, sigma: Tensor) -> "DeepPoly":
+        num_channels = self.x_l_coef.shape[2]
         req_shape = [1] * self.x_l_coef.dim()
-        req_shape[2] = mean.numel()
+        req_shape[2] = num_channels
+        # (x - mean) / sigma as a single affine x * inv_sigma + neg_mean_inv; a scalar mean or sigma is broadcast to all channels
+        inv_sigma = (1.0 / sigma.flatten()).expand(num_channels)
+        neg_mean_inv = (-mean.flatten() * inv_sigma).expand(num_channels)
 
+        def backsub(x_coef, x_bias):
+            # reduce the spatial dims first, so that the bias is a single matmul over the channels
+            x_bias = x_bias + (x_coef.flatten(3).sum(3) if x_coef.dim() > 3 else x_coef).matmul(neg_mean_inv)
+            return x_coef * inv_sigma.view(req_shape), x_bias
 
-        x_l_bias = self.x_l_bias + (self.x_l_coef * (-mean / sigma).view(req_shape)).view(*self.x_l_coef.size()[:2], -1).sum(2)
-        x_u_bias = self.x_u_bias + (self.x_u_coef * (-mean / sigma).view(req_shape)).view(*self.x_u_coef.size()[:2], -1).sum(2)
+        return self._backsub(backsub)
 
-        x_l_coef = self.x_l_coef / sigma.view(req_shape)
-        x_u_coef = self.x_u_coef / sigma.view(req_shape)
-
-        return DeepPoly(x_l_coef, x_u_coef, x_l_bias, x_u_bias)
-
-    def dp_relu(self, bounds: Tuple[Tensor], it: int, dp_lambda:Optional[Tensor]=None) -> "DeepPoly":
+    def dp_relu(self, bounds: Tuple[Tensor], it: int, dp_lambda:Optional[Tensor]=None, cache:Optional[dict]=None) -> "DeepPoly":
+        '''
+        cache is used to reuse the relaxation as long as the bounds are unchanged; learnable slopes (dp_lambda) are never cached
+        '''
         x_lb, x_ub = bounds
 
-        # original DP
-        lambda_l = torch.where(x_ub < -x_lb, torch.zeros_like(x_lb), torch.ones_like(x_lb))
-        # DP-0
-        # lambda_l = torch.where(x_lb<0, torch.zeros_like(x_lb), torch.ones_like(x_lb))
-        lambda_u = x_ub / (x_ub - x_lb + 1e-15)
-
-        if dp_lambda is not None:
-            if it == 0:
-                dp_lambda.data = lambda_l.data
-            lambda_l = dp_lambda.view(lambda_l.shape)
-
-        # stably inactive
-        lambda_l = torch.where(x_ub < 0, torch.zeros_like(x_lb), lambda_l)
-        lambda_u = torch.where(x_ub < 0, torch.zeros_like(x_ub), lambda_u)
-
-        # stably active
-        lambda_l = torch.where(x_lb > 0, torch.ones_like(x_lb), lambda_l)
-        lambda_u = torch.where(x_lb > 0, torch.ones_like(x_ub), lambda_u)
+        if dp_lambda is not None and it == 0:
+            # initialize the learnable lower slope with the original DP choice
+            dp_lambda.data = torch.where(x_ub < -x_lb, torch.zeros_like(x_lb), torch.ones_like(x_lb)).data
 
-        mu_l = torch.zeros_like(x_lb)
-        mu_u = torch.where((x_lb < 0) & (x_ub > 0), -x_ub * x_lb / (x_ub - x_lb + 1e-15),
-                           torch.zeros_like(x_lb))  # height of upper bound intersection with y axis
-
-        lambda_l, lambda_u = lambda_l.unsqueeze(1), lambda_u.unsqueeze(1)
-        mu_l, mu_u = mu_l.unsqueeze(1), mu_u.unsqueeze(1)
-
-        neg_x_l_coef, pos_x_l_coef = get_neg_pos_comp(self.x_l_coef)
-        neg_x_u_coef, pos_x_u_coef = get_neg_pos_comp(self.x_u_coef)
-
-        x_l_coef = pos_x_l_coef * lambda_l + neg_x_l_coef * lambda_u
-        new_x_l_bias = pos_x_l_coef * mu_l + neg_x_l_coef * mu_u
-        x_u_coef = pos_x_u_coef * lambda_u + neg_x_u_coef * lambda_l
-        new_x_u_bias = pos_x_u_coef * mu_u + neg_x_u_coef * mu_l
-
-        if len(new_x_l_bias.size()) == 3:
-            new_x_l_bias = new_x_l_bias.sum(2)
-            new_x_u_bias = new_x_u_bias.sum(2)
+        if dp_lambda is None and cache is not None and cache.get("bounds") is bounds:
+            relaxation = cache["relaxation"]
         else:
-            new_x_l_bias = new_x_l_bias.sum((2, 3, 4))
-            new_x_u_bias = new_x_u_bias.sum((2, 3, 4))
+            relaxation = _relu_relaxation(x_lb, x_ub, dp_lambda)
+            if dp_lambda is None and cache is not None:
+                # keep a reference to the bounds so that the identity check cannot be fooled by a recycled id
+                cache["bounds"], cache["relaxation"] = bounds, relaxation
+
+        x_l_coef, x_u_coef, new_x_l_bias, new_x_u_bias = _relu_fuse(self.x_l_coef, self.x_u_coef, *relaxation)
 
         x_l_bias = self.x_l_bias + new_x_l_bias
         x_u_bias = self.x_u_bias + new_x_u_bias
@@ -176,153 +238,237 @@ class DeepPoly:
         output_padding = (w_padding, h_padding)
 
         sz = self.x_l_coef.shape
+        # a pointwise conv is a matmul over the channel dim, which avoids the slow conv_transpose2d for many small images
+        pointwise = tuple(kernel_wh) == (1, 1) and tuple(stride) == (1, 1) and tuple(padding) == (0, 0) and groups == 1
 
-        # process reference
-        x_l_bias = self.x_l_bias + (0 if bias is None else (self.x_l_coef.sum((3, 4)) * bias).sum(2))
-        x_u_bias = self.x_u_bias + (0 if bias is None else (self.x_u_coef.sum((3, 4)) * bias).sum(2))
+        def backsub(x_coef, x_bias):
+            # process reference
+            x_bias = x_bias + (0 if bias is None else (x_coef.sum((3, 4)) * bias).sum(2))
 
-        new_x_l_coef = F.conv_transpose2d(self.x_l_coef.view((sz[0] * sz[1], *sz[2:])), weight, None, stride, padding,
-                                           output_padding, groups, dilation)
-        new_x_u_coef = F.conv_transpose2d(self.x_u_coef.view((sz[0] * sz[1], *sz[2:])), weight, None, stride, padding,
-                                           output_padding, groups, dilation)
-        #F.pad(new_x_l_coef, (0, 0, w_padding, h_padding), "constant", 0)
-        x_l_coef = new_x_l_coef.view((sz[0], sz[1], *new_x_l_coef.shape[1:]))
-        x_u_coef = new_x_u_coef.view((sz[0], sz[1], *new_x_u_coef.shape[1:]))
+            if pointwise:
+                weight_t = weight[:, :, 0, 0].t()
+                return weight_t.matmul(x_coef.flatten(3)).view((sz[0], sz[1], weight_t.shape[0], *sz[3:])), x_bias
 
-        return DeepPoly(x_l_coef, x_u_coef, x_l_bias, x_u_bias)
+            new_x_coef = F.conv_transpose2d(x_coef.view((sz[0] * sz[1], *sz[2:])), weight, None, stride, padding,
+                                            output_padding, groups, dilation)
+            #F.pad(new_x_coef, (0, 0, w_padding, h_padding), "constant", 0)
+            return new_x_coef.view((sz[0], sz[1], *new_x_coef.shape[1:])), x_bias
 
-    def dp_flatten(self, input_size: Union[torch.Size, List[int]]) -> "DeepPoly":
-        x_l_coef = self.x_l_coef.view(*self.x_l_coef.size()[:2], *input_size)
-        x_u_coef = self.x_u_coef.view(*self.x_u_coef.size()[:2], *input_size)
+        return self._backsub(backsub)
 
-        return DeepPoly(x_l_coef, x_u_coef, self.x_l_bias, self.x_u_bias)
+    def dp_flatten(self, input_size: Union[torch.Size, List[int]]) -> "DeepPoly":
+        return self._backsub(lambda x_coef, x_bias: (x_coef.view(*x_coef.size()[:2], *input_size), x_bias))
 
-    def dp_concretize(self, bounds: Optional[Tuple[Tensor]]=None, abs_input: Optional["HybridZonotope"]=None) -> "DeepPoly":
+    def dp_concretize(self, bounds: Optional[Tuple[Tensor]]=None, abs_input: Optional["HybridZonotope"]=None, idx: Optional[Tensor]=None) -> "DeepPoly":
+        '''
+        idx restricts the concretization to the selected neurons (dim 1)
+        '''
         assert not (bounds is None and abs_input is None)
+        if idx is not None:
+            return self._backsub(lambda x_coef, x_bias: (x_coef.index_select(1, idx), x_bias if x_bias.dim() == 0 else x_bias.index_select(1, idx))).dp_concretize(bounds, abs_input)
         if abs_input is not None and abs_input.domain == "zono":
-            abs_lb = abs_input.flatten().linear(self.x_l_coef.view(-1, abs_input.head.numel()), bias=self.x_l_bias.flatten()).view(self.x_l_bias.shape).concretize()[0]
-            abs_ub = abs_input.flatten().linear(self.x_u_coef.view(-1, abs_input.head.numel()), bias=self.x_u_bias.flatten()).view(self.x_l_bias.shape).concretize()[1]
+            abs_lb = abs_input.flatten().linear(self.x_l_coef.reshape(-1, abs_input.head.numel()), bias=self.x_l_bias.flatten()).view(self.x_l_bias.shape).concretize()[0]
+            abs_ub = abs_input.flatten().linear(self.x_u_coef.reshape(-1, abs_input.head.numel()), bias=self.x_u_bias.flatten()).view(self.x_l_bias.shape).concretize()[1]
             return abs_lb, abs_ub
         if bounds is None:
             bounds = abs_input.concretize()
 
         lb_x, ub_x = bounds
         lb_x, ub_x = lb_x.unsqueeze(1), ub_x.unsqueeze(1)
+        # pos * lb + neg * ub == coef * mid - |coef| * rad, which avoids splitting the coefficients
+        mid_x, rad_x = 0.5 * (ub_x + lb_x), 0.5 * (ub_x - lb_x)
+
+        view_dim = (lb_x.size()[0], self.x_l_coef.size()[1], -1)
 
-        neg_x_l_coef, pos_x_l_coef = get_neg_pos_comp(self.x_l_coef)
-        neg_x_u_coef, pos_x_u_coef = get_neg_pos_comp(self.x_u_coef)
+        x_l_center, x_l_radius = (self.x_l_coef * mid_x).view(view_dim).sum(2), (self.x_l_coef.abs() * rad_x).view(view_dim).sum(2)
+        if self.is_aliased():
+            x_u_center, x_u_radius = x_l_center, x_l_radius
+        else:
+            x_u_center, x_u_radius = (self.x_u_coef * mid_x).view(view_dim).sum(2), (self.x_u_coef.abs() * rad_x).view(view_dim).sum(2)
 
-        x_l_bias = self.x_l_bias + (pos_x_l_coef * lb_x + neg_x_l_coef * ub_x).view(lb_x.size()[0], self.x_l_coef.size()[1], -1).sum(2)
-        x_u_bias = self.x_u_bias + (pos_x_u_coef * ub_x + neg_x_u_coef * lb_x).view(lb_x.size()[0], self.x_l_coef.size()[1], -1).sum(2)
+        x_l_bias = self.x_l_bias + x_l_center - x_l_radius
+        x_u_bias = self.x_u_bias + x_u_center + x_u_radius
 
         return x_l_bias, x_u_bias
 
     def dp_upsample(self, pre_sample_size:Union[Tensor, torch.Size], mode:str, align_corners:bool):
         sz = self.x_l_coef.shape
 
-        new_x_l_coef = F.interpolate(self.x_l_coef.view((-1, *sz[-3:])), size=pre_sample_size, mode=mode,
-                                     align_corners=align_corners)
-        new_x_u_coef = F.interpolate(self.x_u_coef.view((-1, *sz[-3:])), size=pre_sample_size, mode=mode,
-                                     align_corners=align_corners)
+        def backsub(x_coef, x_bias):
+            new_x_coef = F.interpolate(x_coef.view((-1, *sz[-3:])), size=pre_sample_size, mode=mode,
+                                       align_corners=align_corners)
+            return new_x_coef.view((sz[0], sz[1], *new_x_coef.shape[1:])), x_bias
 
-        x_l_coef = new_x_l_coef.view((sz[0], sz[1], *new_x_l_coef.shape[1:]))
-        x_u_coef = new_x_u_coef.view((sz[0], sz[1], *new_x_u_coef.shape[1:]))
-
-        return DeepPoly(x_l_coef, x_u_coef, self.x_l_bias, self.x_u_bias)
+        return self._backsub(backsub)
 
     def dp_batch_norm(self, current_mean: Tensor, current_var: Tensor, weight: Tensor, bias: Tensor, eps: Optional[float]=1e-5) -> "DeepPoly":
         c = (weight / torch.sqrt(current_var + eps))
         b = -current_mean * c + (0 if bias is None else bias)
         view_dim = (1, 1, -1) + (self.x_l_coef.dim()-3)*(1,)
 
-        if self.x_l_coef.dim() == 3: #1d
-            x_l_bias = self.x_l_bias + self.x_l_coef.matmul(b)
-            x_u_bias = self.x_u_bias + self.x_u_coef.matmul(b)
-        elif self.x_l_coef.dim() == 5: #2d
-            x_l_bias = self.x_l_bias + (self.x_l_coef*b.view(view_dim)).sum((-1,-2,-3))
-            x_u_bias = self.x_u_bias + (self.x_u_coef*b.view(view_dim)).sum((-1,-2,-3))
-        else:
+        if self.x_l_coef.dim() not in [3, 5]:
             raise NotImplementedError
 
-        x_l_coef = self.x_l_coef*c.view(view_dim)
-        x_u_coef = self.x_u_coef*c.view(view_dim)
+        def backsub(x_coef, x_bias):
+            if x_coef.dim() == 3: #1d
+                x_bias = x_bias + x_coef.matmul(b)
+            else: #2d
+                # reduce the spatial dims first, so that no full-sized product has to be materialized
+                x_bias = x_bias + x_coef.sum((3, 4)).matmul(b)
+            return x_coef*c.view(view_dim), x_bias
 
-        return DeepPoly(x_l_coef, x_u_coef, x_l_bias, x_u_bias)
+        return self._backsub(backsub)
 
-    def dp_res_block(self, residual, downsample, relu_final, it, dp_lambda):
+    def dp_res_block(self, residual, downsample, relu_final, it, use_lambda=False):
         in_dp_elem = self
 
         if relu_final is not None:
-            in_dp_elem = in_dp_elem.dp_relu(relu_final.bounds, it, dp_lambda["relu_final"] if dp_lambda is not None and relu_final in dp_lambda else None)
+            in_dp_elem = backprop_dp(relu_final, in_dp_elem, it, use_lambda)
 
         id_dp_elem = DeepPoly(in_dp_elem.x_l_coef, in_dp_elem.x_u_coef)
 
-        res_dp_elem = backprop_dp(residual, in_dp_elem, it, dp_lambda["residual"] if dp_lambda is not None and "residual" in dp_lambda else None)
-
-        if downsample is not None:
-            id_dp_elem = backprop_dp(downsample, id_dp_elem, it, dp_lambda["downsample"] if dp_lambda is not None and "downsample" in dp_lambda else None)
+        if downsample is not None and in_dp_elem.x_l_coef.is_cuda:
+            # the two branches are independent, so the downsample branch runs on a side stream concurrently to the residual one
+            current_stream = torch.cuda.current_stream(in_dp_elem.x_l_coef.device)
+            side_stream = _get_side_stream(in_dp_elem.x_l_coef.device)
+            side_stream.wait_stream(current_stream)
+            with torch.cuda.stream(side_stream):
+                id_dp_elem = backprop_dp(downsample, id_dp_elem, it, use_lambda)
+            res_dp_elem = backprop_dp(residual, in_dp_elem, it, use_lambda)
+            current_stream.wait_stream(side_stream)
+            # the results are consumed on the current stream, so their memory must not be reused by the side stream before that
+            for x in (id_dp_elem.x_l_coef, id_dp_elem.x_u_coef, id_dp_elem.x_l_bias, id_dp_elem.x_u_bias):
+                if x.is_cuda:
+                    x.record_stream(current_stream)
+        else:
+            res_dp_elem = backprop_dp(residual, in_dp_elem, it, use_lambda)
+            if downsample is not None:
+                id_dp_elem = backprop_dp(downsample, id_dp_elem, it, use_lambda)
 
         out_dp_elem = id_dp_elem.dp_add(res_dp_elem)
 
         return out_dp_elem
 
 
-def backprop_dp(layer, abs_dp_element, it, use_lambda=False):
-    if isinstance(layer, Sequential):
-        for j in range(len(layer.layers)-1, -1, -1):
-            sub_layer = layer.layers[j]
-            abs_dp_element = backprop_dp(sub_layer, abs_dp_element, it, use_lambda)
-    elif isinstance(layer, Linear):
-        abs_dp_element = abs_dp_element.dp_linear(layer.weight, layer.bias)
-    elif isinstance(layer, Flatten):
-        abs_dp_element = abs_dp_element.dp_flatten(layer.dim)
-    elif isinstance(layer, Normalization):
-        abs_dp_element = abs_dp_element.dp_normalize(layer.mean, layer.sigma)
-    elif isinstance(layer, ReLU):
-        if use_lambda and (layer.deepz_lambda is None or layer.deepz_lambda.shape[0] != layer.bounds[0].shape[0]):
-            layer.deepz_lambda = nn.Parameter(-torch.ones(layer.bounds[0].shape, dtype=torch.float))
-        abs_dp_element = abs_dp_element.dp_relu(layer.bounds, it, layer.deepz_lambda if use_lambda else None)
-    elif isinstance(layer, Conv2d):
-        abs_dp_element = abs_dp_element.dp_conv(layer.dim, layer.weight, layer.bias, layer.stride, layer.padding, layer.groups, layer.dilation)
-    elif isinstance(layer, GlobalAvgPool2d):
-        abs_dp_element = abs_dp_element.dp_global_avg_pool2d(layer.bounds[0].shape)
-    elif isinstance(layer, AvgPool2d):
-        abs_dp_element = abs_dp_element.dp_avg_pool2d(layer.dim, layer.kernel_size, layer.stride, layer.padding)
-    elif isinstance(layer, Upsample):
-        abs_dp_element = abs_dp_element.dp_upsample(layer.dim[-2:], layer.mode, layer.align_corners)
-    elif isinstance(layer, _BatchNorm):
-        if layer.training:
-            mean = layer.current_mean
-            var = layer.current_var
-        else:
-            mean = layer.running_mean
-            var = layer.running_var
-        abs_dp_element = abs_dp_element.dp_batch_norm(mean, var, layer.weight, layer.bias, layer.eps)
-    elif isinstance(layer, Bias):
-        abs_dp_element = abs_dp_element.dp_bias(layer.bias)
-    elif isinstance(layer, Scale):
-        abs_dp_element = abs_dp_element.dp_scale(layer.scale)
-    elif isinstance(layer, ResBlock):
-        abs_dp_element = abs_dp_element.dp_res_block(layer.residual, layer.downsample, layer.relu_final, it, lambda_layer)
-    else:
-        raise RuntimeError(f'Unknown layer type: {type(layer)}')
+class IdentityDeepPoly(DeepPoly):
+    '''
+    Identity expression over the neurons of a layer, i.e. expr_coef = eye(k), optionally restricted to the neurons in idx.
+    Backpropagating through a Linear layer directly yields its (selected) weights; for all other layers the identity is materialized lazily.
+    '''
+    def __init__(self, output_dim: Union[torch.Size, Tuple[int]], device: Union[torch.device, str], idx: Optional[Tensor]=None) -> None:
+        self.output_dim = tuple(output_dim)
+        self.idx = idx
+        self.device = device
+        self.x_l_bias = _ZERO
+        self.x_u_bias = _ZERO
+        self._expr_coef = None
+
+    @property
+    def x_l_coef(self) -> Tensor:
+        if self._expr_coef is None:
+            k = prod(self.output_dim)
+            if self.idx is None:
+                expr_coef = torch.eye(k, device=self.device)
+            else:
+                expr_coef = torch.zeros(len(self.idx), k, device=self.device).scatter_(1, self.idx.unsqueeze(1), 1.0)
+            self._expr_coef = expr_coef.view(-1, *self.output_dim).unsqueeze(0)
+        return self._expr_coef
+
+    x_u_coef = x_l_coef
+
+    def dp_linear(self, weight: Tensor, bias: Tensor) -> "DeepPoly":
+        if self.idx is not None:
+            weight = weight[self.idx]
+            bias = None if bias is None else bias[self.idx]
+        x_coef = weight.unsqueeze(0)
+        x_bias = self.x_l_bias if bias is None else bias.unsqueeze(0)
+        return DeepPoly(x_coef, x_coef, x_bias, x_bias)
+
+
+def _backprop_dp_sequential(layer, abs_dp_element, it, use_lambda):
+    for j in range(len(layer.layers)-1, -1, -1):
+        sub_layer = layer.layers[j]
+        abs_dp_element = backprop_dp(sub_layer, abs_dp_element, it, use_lambda)
     return abs_dp_element
 
-def backward_deeppoly(net, layer_idx, abs_dp_element, it, use_lambda=False, use_intermediate=False, abs_inputs=None):
+
+def _backprop_dp_relu(layer, abs_dp_element, it, use_lambda):
+    if use_lambda and (layer.deepz_lambda is None or layer.deepz_lambda.shape[0] != layer.bounds[0].shape[0]):
+        layer.deepz_lambda = nn.Parameter(-torch.ones(layer.bounds[0].shape, dtype=torch.float))
+    return abs_dp_element.dp_relu(layer.bounds, it, layer.deepz_lambda if use_lambda else None, layer.dp_relu_cache)
+
+
+def _backprop_dp_batch_norm(layer, abs_dp_element, it, use_lambda):
+    if layer.training:
+        mean = layer.current_mean
+        var = layer.current_var
+    else:
+        mean = layer.running_mean
+        var = layer.running_var
+    return abs_dp_element.dp_batch_norm(mean, var, layer.weight, layer.bias, layer.eps)
+
+
+# handlers of backprop_dp, keyed by layer type; subclasses are resolved along their mro on first use
+_BACKPROP_DP = {
+    Sequential: _backprop_dp_sequential,
+    Linear: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_linear(layer.weight, layer.bias),
+    Flatten: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_flatten(layer.dim),
+    Normalization: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_normalize(layer.mean, layer.sigma),
+    ReLU: _backprop_dp_relu,
+    Conv2d: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_conv(layer.dim, layer.weight, layer.bias, layer.stride, layer.padding, layer.groups, layer.dilation),
+    GlobalAvgPool2d: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_global_avg_pool2d(layer.bounds[0].shape),
+    AvgPool2d: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_avg_pool2d(layer.dim, layer.kernel_size, layer.stride, layer.padding),
+    Upsample: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_upsample(layer.dim[-2:], layer.mode, layer.align_corners),
+    _BatchNorm: _backprop_dp_batch_norm,
+    Bias: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_bias(layer.bias),
+    Scale: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_scale(layer.scale),
+    ResBlock: lambda layer, abs_dp_element, it, use_lambda: abs_dp_element.dp_res_block(layer.residual, layer.downsample, layer.relu_final, it, use_lambda),
+}
+
+
+def backprop_dp(layer, abs_dp_element, it, use_lambda=False):
+    layer_type = type(layer)
+    handler = _BACKPROP_DP.get(layer_type)
+    if handler is None:
+        base = next((base for base in layer_type.__mro__ if base in _BACKPROP_DP), None)
+        if base is None:
+            raise RuntimeError(f'Unknown layer type: {layer_type}')
+        handler = _BACKPROP_DP[layer_type] = _BACKPROP_DP[base]
+    return handler(layer, abs_dp_element, it, use_lambda)
+
+
+def backward_deeppoly(net, layer_idx, abs_dp_element, it, use_lambda=False, use_intermediate=False, abs_inputs=None, skip_inactive=False):
+    '''
+    skip_inactive skips the intermediate concretization of neurons which are already proven stably inactive (ub <= 0) for the whole batch, which is used for relu bounds:
+    their relaxation zeroes the coefficients, so the looser bounds are never read again. The bounds of all other neurons, including stably active ones, are the same as without skip_inactive.
+    The pass runs under the autocast setting of the caller (e.g. --use-amp in training); bounds computed in reduced precision are not sound and must only be used for training, never for certification.
+    '''
     x_u_bias, x_l_bias = None, None
+    # intermediate concretizations are combined by a single reduction after the backward pass
+    x_l_bias_list, x_u_bias_list = [], []
 
     for j in range(layer_idx, -1, -1):
         layer = net.layers[j]
         abs_dp_element = backprop_dp(layer, abs_dp_element, it, use_lambda)
 
         if j == 0 or (use_intermediate and layer.bounds is not None):
-            x_l_bias_tmp, x_u_bias_tmp = abs_dp_element.dp_concretize(layer.bounds if j > 0 else None, None if j > 0 else abs_inputs)
-            if x_u_bias is not None:
-                x_l_bias = torch.maximum(x_l_bias, x_l_bias_tmp)
-                x_u_bias = torch.minimum(x_u_bias, x_u_bias_tmp)
+            if x_u_bias is None:
+                x_l_bias, x_u_bias = abs_dp_element.dp_concretize(layer.bounds if j > 0 else None, None if j > 0 else abs_inputs)
+            elif skip_inactive:
+                idx = (x_u_bias > 0).any(0).nonzero().squeeze(1)
+                if len(idx) == 0:
+                    break
+                x_l_bias_tmp, x_u_bias_tmp = abs_dp_element.dp_concretize(layer.bounds if j > 0 else None, None if j > 0 else abs_inputs, idx)
+                x_l_bias = x_l_bias.index_copy(1, idx, torch.maximum(x_l_bias.index_select(1, idx), x_l_bias_tmp))
+                x_u_bias = x_u_bias.index_copy(1, idx, torch.minimum(x_u_bias.index_select(1, idx), x_u_bias_tmp))
             else:
-                x_l_bias = x_l_bias_tmp
-                x_u_bias = x_u_bias_tmp
+                x_l_bias_tmp, x_u_bias_tmp = abs_dp_element.dp_concretize(layer.bounds if j > 0 else None, None if j > 0 else abs_inputs)
+                x_l_bias_list.append(x_l_bias_tmp)
+                x_u_bias_list.append(x_u_bias_tmp)
+
+    if len(x_l_bias_list) > 0:
+        x_l_bias = torch.stack([x_l_bias] + x_l_bias_list, 0).amax(0)
+        x_u_bias = torch.stack([x_u_bias] + x_u_bias_list, 0).amin(0)
 
     return x_l_bias, x_u_bias
 
@@ -336,50 +482,69 @@ def get_layer_sizes(net, x):
     return layer_sizes
 
 
-def compute_dp_relu_bounds(net, max_layer_id, abs_input, it, already_bounded_layers, use_lambda=False, recompute_bounds=True, use_intermediate=False):
-    x = abs_input.head
-    device = x.device
-    
-    if max_layer_id == 0:
-        x_l_bias, x_u_bias = abs_input.concretize()
+def compute_dp_layer_bounds(net, relu_id, abs_input, it, use_lambda=False, use_intermediate=False, skip_inactive=True):
+    '''
+    Bound the input of layer relu_id with DeepPoly, assuming all earlier relu layers are already bounded.
+    '''
+    if relu_id == 0:
+        net.layers[relu_id].update_bounds(abs_input.concretize())
+        return
+
+    # Remark: this is impossible to do batch-wise, as expr_coef needs to be enlarged by batch_size times and leads to memory overflow.
+    # Instead, skip_inactive skips neurons that are stably inactive for the whole batch: the relu zeroes their coefficients, so their bounds are never read again.
+    # Stably active neurons are still bounded, as their bounds are used by the intermediate concretization of later layers.
+    layer = net.layers[relu_id]
+    if layer.bounds is None or not skip_inactive:
+        idx = None
     else:
-        # first relu bound is exact for IBP
-        is_first_relu = True
-        # bound all previous possible relu layers; use already_bounded_layers to avoid recomputing bounds (Dynamic Programming style for DeepPoly :))
-        for i, layer in enumerate(net.layers[:max_layer_id]):
-            if isinstance(layer, ReLU) and i not in already_bounded_layers:
-                if layer.bounds is None or recompute_bounds:
-                    if not (is_first_relu and layer.bounds is not None):
-                        compute_dp_relu_bounds(net, i, abs_input, it, already_bounded_layers, use_lambda, use_intermediate=use_intermediate)
-                is_first_relu = False
-                already_bounded_layers.append(i)
-
-        # if the last layer is not a ReLU, we don't need to do anything
-        if not isinstance(net.layers[max_layer_id], ReLU):
+        lb, ub = layer.bounds[0].flatten(1), layer.bounds[1].flatten(1)
+        idx = (ub > 0).any(0).nonzero().squeeze(1)
+        if len(idx) == 0:
             return
-        
-        # TODO: only backward_dp unstable relu
-        # Remark: this is impossible to do batch-wise? As expr_coef needs to be enlarged by batch_size times and leads to memory overflow.
-        # The only thing we could do is to ignore neurons that are stable for the whole batch. Don't feel necessary to do this.
-        last_layer = net.layers[max_layer_id]
-        k = int(np.prod(last_layer.output_dim))
-        expr_coef = torch.eye(k, device=device).view(-1, *last_layer.output_dim).unsqueeze(0)
-        abs_dp_element = DeepPoly(expr_coef=expr_coef)
-        x_l_bias, x_u_bias = backward_deeppoly(net, max_layer_id - 1, abs_dp_element, it, use_lambda, use_intermediate, abs_input)
+    abs_dp_element = IdentityDeepPoly(layer.output_dim, abs_input.head.device, idx)
+    x_l_bias, x_u_bias = backward_deeppoly(net, relu_id - 1, abs_dp_element, it, use_lambda, use_intermediate, abs_input, skip_inactive=skip_inactive)
+    if idx is not None:
+        # stably inactive neurons keep their existing bounds
+        x_l_bias = lb.index_copy(1, idx, x_l_bias)
+        x_u_bias = ub.index_copy(1, idx, x_u_bias)
 
-    net.layers[max_layer_id].update_bounds((x_l_bias, x_u_bias))
+    layer.update_bounds((x_l_bias, x_u_bias))
 
 
-def forward_deeppoly(net, abs_input, expr_coef=None, it=0, use_lambda=False, recompute_bounds=False, use_intermediate=True):
+def compute_dp_relu_bounds(net, max_layer_id, abs_input, it, already_bounded_layers, use_lambda=False, recompute_bounds=True, use_intermediate=False, skip_inactive=True):
+    '''
+    Bound all relu layers up to max_layer_id (and max_layer_id itself if it is a relu) with DeepPoly in a single bottom-up sweep.
+    already_bounded_layers is a set of layer ids whose bounds are kept (Dynamic Programming style for DeepPoly :)); it is updated in place.
+    '''
+    if max_layer_id == 0:
+        net.layers[0].update_bounds(abs_input.concretize())
+        return
+
+    # first relu bound is exact for IBP
+    is_first_relu = True
+    # Remark: the layers have to be bounded in order, since the backward pass of each relu goes through the relaxations of all earlier relus.
+    # Hence there is no independent work across relu layers that could be overlapped, e.g. on separate CUDA streams.
+    for i, layer in enumerate(net.layers[:max_layer_id]):
+        if isinstance(layer, ReLU) and i not in already_bounded_layers:
+            if (layer.bounds is None or recompute_bounds) and not (is_first_relu and layer.bounds is not None):
+                compute_dp_layer_bounds(net, i, abs_input, it, use_lambda, use_intermediate, skip_inactive)
+            is_first_relu = False
+            already_bounded_layers.add(i)
+
+    # if the last layer is not a ReLU, we don't need to do anything
+    if isinstance(net.layers[max_layer_id], ReLU):
+        compute_dp_layer_bounds(net, max_layer_id, abs_input, it, use_lambda, use_intermediate, skip_inactive)
+
+
+def forward_deeppoly(net, abs_input, expr_coef=None, it=0, use_lambda=False, recompute_bounds=False, use_intermediate=True, skip_inactive=True):
     net.set_dim(abs_input.concretize()[0][0:1])
     x = net(abs_input.head)
 
     if recompute_bounds:
-        compute_dp_relu_bounds(net, len(net.layers)-1, abs_input, it, already_bounded_layers=[], use_lambda=False, use_intermediate=use_intermediate)
+        compute_dp_relu_bounds(net, len(net.layers)-1, abs_input, it, already_bounded_layers=set(), use_lambda=False, use_intermediate=use_intermediate, skip_inactive=skip_inactive)
 
     if expr_coef is None:
-        k = int(np.prod(x[0].size()))
-        abs_dp_element = DeepPoly(expr_coef=torch.eye(k).view(-1, *x[0].size()).unsqueeze(0).to(abs_input.head.device))
+        abs_dp_element = IdentityDeepPoly(x[0].size(), abs_input.head.device)
     else:
         abs_dp_element = DeepPoly(expr_coef=expr_coef)
 
@@ -7,12 +7,16 @@ import numpy as np
 import torch.nn.functional as F
 import time
 import unittest
+import itertools
 import sys
 sys.path.append("..")
 from model_wrapper import get_model_wrapper, BasicModelWrapper, PGDModelWrapper, MultiPGDModelWrapper, BoxModelWrapper, TAPSModelWrapper, SmallBoxModelWrapper, STAPSModelWrapper, DeepPolyModelWrapper, ARoWModelWrapper, MARTModelWrapper, MTLIBPModelWrapper, CCIBPModelWrapper, EXPIBPModelWrapper, BasicFunctionWrapper, GradAccuFunctionWrapper, WeightSmoothFunctionWrapper, SAMFunctionWrapper
 from AIDomains.abstract_layers import Sequential, _BatchNorm, Linear, Conv2d
 import AIDomains.abstract_layers as abs_layers
-from utils import seed_everything
+import AIDomains.concrete_layers as concrete_layers
+from AIDomains.zonotope import HybridZonotope
+from AIDomains.deeppoly import forward_deeppoly
+from utils import seed_everything, reset_bn_to_population_statistics
 from bunch import Bunch
 
 class Argument:
@@ -477,6 +481,100 @@ class TestDeepPolyModelWrapper(Tester):
                 self.assertLess((layer.bounds[0] - layer.bounds[1]).abs().max(), 1e-6)
         self.assertTrue(has_no_grad(wrapper.net))
 
+    def test_scalar_normalization(self):
+        # a normalization with a single mean and std should give the same DeepPoly bounds as the per-channel one
+        x, y = self._get_random_input()
+        input_dim = tuple(x.shape[1:])
+        layers = [nn.Flatten(), nn.Linear(int(np.prod(input_dim)), 10), nn.ReLU(), nn.Linear(10, 10)]
+        net_scalar = Sequential.from_concrete_network(nn.Sequential(concrete_layers.Normalization(input_dim, [0.5], [0.25]), *layers), input_dim, disconnect=True)
+        net_channel = Sequential.from_concrete_network(nn.Sequential(concrete_layers.Normalization(input_dim, [0.5]*input_dim[0], [0.25]*input_dim[0]), *layers), input_dim, disconnect=True)
+        eps = 0.05
+        x_abs = HybridZonotope.construct_from_bounds(x - eps, x + eps, domain='box')
+        with torch.no_grad():
+            lb1, ub1 = forward_deeppoly(net_scalar, x_abs, recompute_bounds=True)
+            lb2, ub2 = forward_deeppoly(net_channel, x_abs, recompute_bounds=True)
+        self.assertLess((lb1 - lb2).abs().max(), 1e-5)
+        self.assertLess((ub1 - ub2).abs().max(), 1e-5)
+
+    def test_skip_inactive(self):
+        # skipping the stably inactive neurons must not change the DeepPoly bounds
+        for seed in range(20):
+            torch.manual_seed(seed)
+            layers = [nn.Flatten(), nn.Linear(2, 4)]
+            for _ in range(3):
+                layers += [nn.ReLU(), nn.Linear(4, 4)]
+            net = Sequential.from_concrete_network(nn.Sequential(*layers), (2,), disconnect=True)
+            x = torch.rand(3, 2)
+            for eps, ibp_first in itertools.product([0.1, 0.5, 1.0], [False, True]):
+                x_abs = HybridZonotope.construct_from_bounds(x - eps, x + eps, domain='box')
+                bounds, relu_bounds = [], []
+                for skip_inactive in [True, False]:
+                    net.reset_bounds()
+                    with torch.no_grad():
+                        if ibp_first:
+                            # start from the IBP bounds, as in propagate_abs
+                            net(x_abs)
+                        bounds.append(forward_deeppoly(net, x_abs, recompute_bounds=True, skip_inactive=skip_inactive))
+                    relu_bounds.append([layer.bounds for layer in net.layers if isinstance(layer, abs_layers.ReLU)])
+                self.assertLess((bounds[0][0] - bounds[1][0]).abs().max(), 1e-5)
+                self.assertLess((bounds[0][1] - bounds[1][1]).abs().max(), 1e-5)
+                # intermediate bounds may only differ for stably inactive neurons, which are never read again
+                for (lb1, ub1), (lb2, ub2) in zip(*relu_bounds):
+                    inactive = ub2 <= 0
+                    self.assertLess((lb1 - lb2).abs().masked_fill(inactive, 0).max(), 1e-5)
+                    self.assertLess((ub1 - ub2).abs().masked_fill(inactive, 0).max(), 1e-5)
+
+    def _get_res_block_network(self, device="cpu"):
+        torch.manual_seed(0)
+        downsample = abs_layers.Sequential(abs_layers.Conv2d(4, 8, kernel_size=1, stride=2, bias=False), abs_layers.BatchNorm2d(8, affine=True))
+        # BasicBlock uses non-affine BatchNorm2d, which cannot be constructed; FixupBasicBlock takes the same path through dp_res_block
+        block = abs_layers.FixupBasicBlock(4, 4, 8, stride=2, downsample=downsample)
+        net = abs_layers.Sequential(abs_layers.Conv2d(2, 4, 3, 1, 1), abs_layers.ReLU((4, 4, 4)), block, abs_layers.ReLU((8, 2, 2)), abs_layers.Flatten(), abs_layers.Linear(8*2*2, 10))
+        # output_dim is otherwise only set by from_concrete_network, which has no ResBlock; DeepPoly needs it to recompute the relu bounds
+        net.layers[1].output_dim = (4, 4, 4)
+        net.layers[3].output_dim = (8, 2, 2)
+        for m in net.modules():
+            if isinstance(m, abs_layers.Bias):
+                m.bias.data.uniform_(-0.2, 0.2)
+            elif isinstance(m, abs_layers.Scale):
+                m.scale.data.uniform_(0.5, 1.5)
+            elif isinstance(m, _BatchNorm):
+                m.running_mean.uniform_(-0.2, 0.2)
+                m.running_var.uniform_(0.5, 1.5)
+        net.eval()
+        return net.to(device)
+
+    def _get_res_block_bounds(self, net, x, eps):
+        x_abs = HybridZonotope.construct_from_bounds(x - eps, x + eps, domain='box')
+        net.reset_bounds()
+        net.set_dim(x[0:1])
+        with torch.no_grad():
+            # IBP bounds the relus inside the block, as in propagate_abs
+            net(x_abs)
+            return forward_deeppoly(net, x_abs, recompute_bounds=True)
+
+    def test_res_block(self):
+        # DeepPoly bounds of a ResBlock network with a downsample branch should contain the outputs of sampled inputs
+        net = self._get_res_block_network()
+        x = torch.rand(4, 2, 4, 4)
+        eps = 0.05
+        lb, ub = self._get_res_block_bounds(net, x, eps)
+        with torch.no_grad():
+            for _ in range(100):
+                out = net(x + eps * (2 * torch.rand_like(x) - 1))
+                self.assertTrue((lb <= out + 1e-5).all())
+                self.assertTrue((out <= ub + 1e-5).all())
+
+    @unittest.skipUnless(torch.cuda.is_available(), "the ResBlock side stream needs CUDA")
+    def test_res_block_stream(self):
+        # on CUDA the downsample branch is backpropagated on a side stream, which should match the serial CPU path
+        x = torch.rand(4, 2, 4, 4)
+        eps = 0.05
+        lb_cpu, ub_cpu = self._get_res_block_bounds(self._get_res_block_network("cpu"), x, eps)
+        lb_cuda, ub_cuda = self._get_res_block_bounds(self._get_res_block_network("cuda"), x.to("cuda"), eps)
+        self.assertLess((lb_cpu - lb_cuda.cpu()).abs().max(), 1e-4)
+        self.assertLess((ub_cpu - ub_cuda.cpu()).abs().max(), 1e-4)
+
     def test_nonnegative_weight(self):
         # for nonnegative net, DPBox should equivalent to DeepPoly
         x, y = self._get_random_input()
@@ -946,6 +1044,29 @@ class TestSAMFunctionWrapper(TestBasicFunctionWrapper):
             self.assertAlmostEqual((layer.weight - original_weights[id]).abs().max().item(), 0, delta=1e-6)
 
 
+class TestResetBNToPopulationStatistics(unittest.TestCase):
+    def test_single_batch(self):
+        # with a single batch, the population statistics are the mean and unbiased variance of that batch
+        net = nn.Sequential(Conv2d(2, 4, 3, 1, 1), abs_layers.BatchNorm2d(4, affine=True), abs_layers.ReLU(), nn.Dropout(0.5), Conv2d(4, 2, 3), abs_layers.BatchNorm2d(2, affine=True))
+        net.train()
+        for m in net.modules():
+            if isinstance(m, _BatchNorm):
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.2, 0.2)
+                m.num_batches_tracked += 3
+        x = torch.rand(8, 2, 4, 4)
+        reset_bn_to_population_statistics(net, [(x, None)], "cpu")
+        with torch.no_grad():
+            bn_in = [net[0](x)]
+            # the first BN normalizes with the batch statistics during the pass, and the dropout is off
+            out = F.batch_norm(bn_in[0], None, None, net[1].weight, net[1].bias, True, 0., net[1].eps)
+            bn_in.append(net[4](torch.relu(out)))
+        for bn, h in zip((net[1], net[5]), bn_in):
+            self.assertLess((bn.running_mean - h.mean((0, 2, 3))).abs().max(), 1e-5)
+            self.assertLess((bn.running_var - h.var((0, 2, 3), unbiased=True)).abs().max(), 1e-5)
+            self.assertEqual(bn.num_batches_tracked.item(), 3)
+        self.assertTrue(net[3].training)
+
 if __name__ == "__main__":
     seed_everything(123)
     unittest.main()
\ No newline at end of file
@@ -12,7 +12,7 @@ import AIDomains.concrete_layers as conc_layers
 from AIDomains.wrapper import propagate_abs
 from AIDomains.ai_util import construct_C
 from typing import Callable, Iterable, List, Tuple, Final, Union, Optional
-from utils import project_to_bounds, log_cuda_memory, seed_everything
+from utils import project_to_bounds_, log_cuda_memory, seed_everything
 import logging
 import torch.jit as jit
 
@@ -806,8 +806,8 @@ class _MultiPGDMixin:
                         grad = torch.autograd.grad(loss, pts)[0]
                         assert not torch.isnan(grad).any(), "nan found in grad during attack; If automatic mixed precision is used, try a smaller scaling factor (usually not recommended). Otherwise, it usually indicates grad overflow due to inproper output scale."
 
-                        new_pts = pts - grad.sign() * lr * variety
-                        pts = project_to_bounds(new_pts, lb.unsqueeze(1), ub.unsqueeze(1)).detach()
+                        new_pts = pts.detach() - grad.sign() * lr * variety
+                        pts = project_to_bounds_(new_pts, lb.unsqueeze(1), ub.unsqueeze(1))
                         if (it+1) in lr_decay_milestones:
                             lr *= lr_decay_factor
         return best_pts
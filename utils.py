@@ -9,16 +9,30 @@ import copy
 from AIDomains.abstract_layers import BatchNorm1d, BatchNorm2d, Linear, Conv2d, Sequential, _BatchNorm
 import random
 import math
+import functools
+import importlib.metadata
 try:
-    from pip._internal.operations import freeze
-except ImportError: # pip < 10.0
-    from pip.operations import freeze
+    import orjson
+except ImportError:
+    orjson = None
 
 from math import log10, floor
 
 def round_sig(x, sig=2):
+    if np.ndim(x) > 0:
+        return round_sig_array(x, sig)
+    if x == 0:
+        return x
     return round(x, sig-int(floor(log10(abs(x))))-1)
 
+def round_sig_array(x, sig=2):
+    # vectorized round_sig; zeros stay zero
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide="ignore"):
+        mag = np.where(x == 0, 0, np.floor(np.log10(np.abs(x)))).astype(int)
+    scale = 10.0 ** (sig - 1 - mag)
+    return np.round(x * scale) / scale
+
 log_id = 0
 def log_cuda_memory():
     global log_id
@@ -31,38 +45,72 @@ def log_cuda_memory():
 
 def project_to_bounds(x, lb, ub):
     # requires x.shape[1:] == lb.shape[1:] and lb.shape[0] == 1
-    return torch.max(torch.min(x, ub), lb)
+    return torch.clamp(x, min=lb, max=ub)
+
+def project_to_bounds_(x, lb, ub):
+    # in-place version of project_to_bounds
+    return x.clamp_(min=lb, max=ub)
 
 def clamp_image(x, eps):
-    min_x = torch.clamp(x-eps, min=0)
-    max_x = torch.clamp(x+eps, max=1)
-    x_center = 0.5 * (max_x + min_x)
-    x_betas = 0.5 * (max_x - min_x)
+    # in-place ops on the fresh intermediates, s.t. only two temporaries besides the outputs are allocated
+    min_x = (x - eps).clamp_(min=0)
+    max_x = (x + eps).clamp_(max=1)
+    x_betas = max_x.sub_(min_x).mul_(0.5)
+    x_center = min_x + x_betas
     return x_center, x_betas
 
 def reset_bn_to_population_statistics(model, dataloader, device):
     '''
     Use population statistics to reset the BN layers in the model.
+    The inputs of the BN layers are accumulated by hooks during a training-mode pass, i.e., the activations are normalized with batch statistics as in training.
     '''
     model.to(device)
     bn_list = [m for m in model.modules() if isinstance(m, _BatchNorm)]
     if len(bn_list) == 0:
         return model
     model.train()
-    momentum_list = [m.momentum for m in bn_list]
-    num_batches_tracked = 0
-    for x, _ in dataloader:
-        x = x.to(device)
-        num_batches_tracked += 1
-        with torch.no_grad():
-            for m in bn_list:
-                m.momentum = 1 / num_batches_tracked
-            model(x)
+    # only the BN layers need training mode; the mode of the dropout layers is restored after the pass
+    dropout_training = {m: m.training for m in model.modules() if isinstance(m, nn.modules.dropout._DropoutNd)}
+    for m in dropout_training:
+        m.eval()
+    stats = {m: [0, 0, 0] for m in bn_list} # sum, sum of squares, count
+
+    def accumulate(m, args):
+        x = args[0].double()
+        stats[m][0] = stats[m][0] + x.sum(dim=m.mean_dim)
+        stats[m][1] = stats[m][1] + (x * x).sum(dim=m.mean_dim)
+        stats[m][2] += x.numel() // x.shape[1]
+
+    handles = [m.register_forward_pre_hook(accumulate) for m in bn_list]
+    try:
+        with torch.inference_mode():
+            for x, _ in dataloader:
+                model(x.to(device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        for m, training in dropout_training.items():
+            m.train(training)
+
+    for m in bn_list:
+        sum_x, sum_xx, count = stats[m]
+        if count == 0:
+            continue
+        mean = sum_x / count
+        # unbiased, as BN stores the unbiased variance in running_var
+        var = (sum_xx / count - mean * mean).clamp(min=0) * count / max(count - 1, 1)
+        m.running_mean.data.copy_(mean)
+        m.running_var.data.copy_(var)
     for m in bn_list:
-        m.momentum = momentum_list.pop(0)
+        # the batch statistics of the last pass are inference tensors, which cannot be used by autograd
+        m.set_current_to_running()
     return model
 
-def seed_everything(seed, strict=False):
+def seed_everything(seed, strict=False, device="cuda"):
+    '''
+    Seed the global RNGs. Also returns seeded generators for CPU and the given cuda device (None if cuda is unavailable),
+    which can be passed explicitly to random ops instead of going through the global default generators.
+    '''
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -70,6 +118,13 @@ def seed_everything(seed, strict=False):
     if strict:
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
+    g_cpu = torch.Generator()
+    g_cpu.manual_seed(seed)
+    g_cuda = None
+    if torch.cuda.is_available():
+        g_cuda = torch.Generator(device=device)
+        g_cuda.manual_seed(seed)
+    return g_cpu, g_cuda
 
 class Scheduler:
     def __init__(self, start_epoch, end_epoch, start_value, end_value, mode="linear", c=0.25, e=4, s=500):
@@ -86,6 +141,23 @@ class Scheduler:
         assert e >= 1, "please choose an exponent >= 1"
         # assert 0 < c < 0.5, "please choose c in the range (0,0.5)"
         self.last_value = None
+        if self.end_epoch > self.start_epoch:
+            self._precompute()
+
+    def _precompute(self):
+        # constants of the schedule which do not depend on the epoch
+        width = self.end_epoch - self.start_epoch
+        if self.mode == "log_linear":
+            self._log_start = math.log(self.start_value)
+            self._log_delta = math.log(self.end_value) - math.log(self.start_value)
+        elif self.mode == "smooth":
+            d = self.end_value - self.start_value
+            t = (self.mid_epoch - self.start_epoch) ** (self.e - 1)
+            self._alpha = d / ((self.end_epoch - self.mid_epoch) * self.e * t + (self.mid_epoch - self.start_epoch) * t)
+            self._mid_value = self.start_value + self._alpha * (self.mid_epoch - self.start_epoch) ** self.e
+        elif self.mode == "step":
+            self._n_steps = int(width/self.s)
+            self._delta = (self.end_value - self.start_value) / self._n_steps
 
     def getcurrent(self, epoch):
         if epoch < self.start_epoch:
@@ -99,24 +171,15 @@ class Scheduler:
             current = self.start_value + (epoch - self.start_epoch) / (self.end_epoch - self.start_epoch) * \
                   (self.end_value - self.start_value)
         elif self.mode == "log_linear":
-            current = math.exp(math.log(self.start_value) + (epoch - self.start_epoch) / (self.end_epoch - self.start_epoch) * \
-                  (math.log(self.end_value) - math.log(self.start_value)))
+            current = math.exp(self._log_start + (epoch - self.start_epoch) / (self.end_epoch - self.start_epoch) * self._log_delta)
         elif self.mode == "smooth":
-            c = self.c # portion of the mid point
-            e = self.e
-            width = self.end_epoch - self.start_epoch
-            mid_epoch = int(c * width) + self.start_epoch
-            d = self.end_value - self.start_value
-            t = (mid_epoch - self.start_epoch) ** (e - 1)
-            alpha = d / ((self.end_epoch - mid_epoch) * e * t + (mid_epoch - self.start_epoch) * t)
-            mid_value = self.start_value + alpha * (mid_epoch - self.start_epoch) ** e
-            exp_value = self.start_value + alpha * float(epoch - self.start_epoch) ** e
-            linear_value = min(mid_value + (self.end_value - mid_value) * (epoch - mid_epoch) / (self.end_epoch - mid_epoch), self.end_value)
-            current = exp_value if epoch <= mid_epoch else linear_value
+            mid_epoch = self.mid_epoch
+            if epoch <= mid_epoch:
+                current = self.start_value + self._alpha * float(epoch - self.start_epoch) ** self.e
+            else:
+                current = min(self._mid_value + (self.end_value - self._mid_value) * (epoch - mid_epoch) / (self.end_epoch - mid_epoch), self.end_value)
         elif self.mode == "step":
-            n_steps = int((self.end_epoch - self.start_epoch)/self.s)
-            delta = (self.end_value -self.start_value) / n_steps
-            current = np.ceil((epoch-self.start_epoch+0.1)/(self.end_epoch-self.start_epoch)*n_steps)*delta + self.start_value
+            current = np.ceil((epoch-self.start_epoch+0.1)/(self.end_epoch-self.start_epoch)*self._n_steps)*self._delta + self.start_value
         else:
             raise NotImplementedError
         self.last_value = current
@@ -125,10 +188,19 @@ class Scheduler:
     def getlast(self):
         return self.last_value
 
+@functools.lru_cache(maxsize=1)
+def _frozen_pkgs():
+    # read the installed distributions from their metadata instead of running pip freeze
+    pkgs = {f"{d.metadata['Name']}=={d.version}" for d in importlib.metadata.distributions() if d.metadata['Name']}
+    return tuple(sorted(pkgs, key=str.lower))
+
 class Logger(object):
-    def __init__(self, filename, stdout):
+    # the log file is block-buffered and only flushed to disk on every flush_every-th flush call and on close
+    def __init__(self, filename, stdout, flush_every:int=64):
         self.terminal = stdout
-        self.log = open(filename, "a")
+        self.log = open(filename, "a", buffering=1<<16)
+        self.flush_every = flush_every
+        self._num_flushes = 0
 
     def write(self, message):
         self.terminal.write(message)
@@ -136,7 +208,9 @@ class Logger(object):
 
     def flush(self):
         self.terminal.flush()
-        self.log.flush()
+        self._num_flushes += 1
+        if self._num_flushes % self.flush_every == 0:
+            self.log.flush()
 
     def close(self):
         self.log.close()
@@ -160,7 +234,7 @@ class Logger(object):
     def log_env(self, verbose=False):
         write = self._get_writer(verbose)
         write("\nEnvironment Info:")
-        pkgs = freeze.freeze()
+        pkgs = _frozen_pkgs()
         for pkg in pkgs:
             write(pkg)
 
@@ -204,7 +278,8 @@ class Statistics:
 
     def update(self, x, num:int=1):
         if self.momentum is None:
-            self.avg = self.avg * (self.n / (self.n + num)) + x * num / (self.n + num)
+            # incremental mean, which avoids the cancellation of rescaling avg for large n
+            self.avg = self.avg + (x - self.avg) * (num / (self.n + num))
         else:
             if self.n == 0:
                 self.avg = x
@@ -213,68 +288,143 @@ class Statistics:
         self.n += num
         self.last = x
 
+    def update_tensor(self, x:torch.Tensor, num:int=1):
+        '''
+        Same as update, but avg and last stay (detached) tensors on the device of x, s.t. no synchronization is needed until they are read.
+        '''
+        self.update(x.detach(), num)
+
     @staticmethod
     def get_statistics(k, **kwargs):
         return [Statistics(**kwargs) for _ in range(k)]
 
+class VectorStatistics:
+    '''
+    Statistics of k metrics which are updated together, stored as arrays s.t. one update is a single vectorized operation.
+    If momentum = None, calculate the average of all the values.
+    Else if momentum in (0, 1), calculate the exponential moving average.
+    '''
+    def __init__(self, k:int, momentum:float=None):
+        self.n = np.zeros(k, dtype=np.int64)
+        self.avg = np.zeros(k)
+        self.last = np.zeros(k)
+        self.momentum = momentum
+
+    def update(self, x, num=1):
+        x = np.asarray(x, dtype=float)
+        if self.momentum is None:
+            self.avg = self.avg + (x - self.avg) * (num / (self.n + num))
+        else:
+            self.avg = np.where(self.n == 0, x, self.avg * (1-self.momentum) + x * self.momentum)
+        self.n = self.n + num
+        self.last = x
+
+def _has_nonfinite(obj):
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, (np.ndarray, np.floating)):
+        return np.issubdtype(obj.dtype, np.floating) and not np.isfinite(obj).all()
+    return False
+
 def write_perf_to_json(perf_dict, save_root, filename:str="monitor.json"):
     filepath = os.path.join(save_root, filename)
+    # orjson writes non-finite floats as null, so these are left to json which keeps NaN/Infinity
+    if orjson is not None and not _has_nonfinite(perf_dict):
+        with open(filepath, "wb") as f:
+            f.write(orjson.dumps(perf_dict, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+        return
+    # orjson only supports an indentation of 2
     with open(filepath, "w") as f:
-        json.dump(perf_dict, f, indent=4)
+        json.dump(perf_dict, f, indent=2)
 
 def load_perf_from_json(load_root, filename:str="monitor.json"):
     filepath = os.path.join(load_root, filename)
     if not os.path.isfile(filepath):
         print(filepath, "does not exist!")
         return None
-    with open(filepath, "r") as f:
-        perf_dict = json.load(f)
-    return perf_dict
-
+    with open(filepath, "rb") as f:
+        content = f.read()
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass # e.g. NaN written by the json fallback
+    return json.loads(content)
+
+@torch.no_grad()
 def get_model_param_stat(net, tol=1e-10, ndigits=4):
     d = dict()
-    dead_count = 0
+    # accumulate on device and synchronize only once at the end
+    dead_counts, min_values, max_values = [], [], []
     total_count = 0
-    min_value, max_value = 1e10, -1e10
     for param in net.parameters():
-        dead_count += (param.abs() <= tol).sum().item()
+        dead_counts.append((param.abs() <= tol).sum())
         total_count += param.numel()
-        min_param, max_param = param.min().item(), param.max().item()
-        min_value, max_value = min(min_value, min_param), max(max_value, max_param)
+        min_param, max_param = torch.aminmax(param)
+        min_values.append(min_param)
+        max_values.append(max_param)
+    dead_count, min_value, max_value = torch.stack([torch.stack(dead_counts).sum().double(), torch.stack(min_values).min().double(), torch.stack(max_values).max().double()]).tolist()
     d['dead_ratio'] = round(dead_count / total_count, ndigits=ndigits)
     d['min_value'] = round(min_value, ndigits=ndigits)
     d['max_value'] = round(max_value, ndigits=ndigits)
     return d
 
-def pertub_model_param(model, noise_rate=1e-4):
-    state_dict = model.state_dict()
-    for key, weight in state_dict.items():
-        noise = (torch.rand_like(weight) - 0.5) * noise_rate
-        state_dict[key] = weight + noise
-    model.load_state_dict(state_dict)
+@torch.no_grad()
+def pertub_model_param(model, noise_rate=1e-4, generator=None):
+    # perturb in place; integer buffers such as num_batches_tracked are left untouched
+    # generator (e.g. returned by seed_everything) has to be on the device of the model
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.is_floating_point():
+            tensor.add_(torch.empty_like(tensor).uniform_(-0.5 * noise_rate, 0.5 * noise_rate, generator=generator))
+
+def _copy_with_new_param(layer, weight, bias):
+    '''
+    Deep copy of layer with fresh weight and bias parameters; the memo maps the old parameters to the new ones, so they are not copied.
+    '''
+    new_weight = nn.Parameter(weight, requires_grad=layer.weight.requires_grad)
+    new_bias = nn.Parameter(bias, requires_grad=layer.weight.requires_grad if layer.bias is None else layer.bias.requires_grad)
+    memo = {id(layer.weight): new_weight}
+    if layer.bias is not None:
+        memo[id(layer.bias)] = new_bias
+    new_layer = copy.deepcopy(layer, memo)
+    new_layer.bias = new_bias
+    return new_layer
+
+@torch.jit.script
+def _fuse_bn_channel(w: torch.Tensor, b: torch.Tensor, mu: torch.Tensor, var: torch.Tensor, eps: float):
+    # per-channel scale and offset of the BN in eval mode, i.e. bn(x) = s * x + offset
+    s = w / torch.sqrt(var + eps)
+    return s, b - s * mu
 
 def fuse_BN2d_to_Conv2d(BN2d, Conv2d):
     '''
     Adapted from: https://nenadmarkus.com/p/fusing-batchnorm-and-conv/
     '''
-    Conv2d = copy.deepcopy(Conv2d)
-    w_conv = Conv2d.weight.clone().view(Conv2d.out_channels, -1)
-    bv = torch.sqrt(BN2d.eps + BN2d.running_var)
-    w_bn = torch.diag(BN2d.weight.data / bv)
-    Conv2d.weight.data = torch.matmul(w_bn, w_conv).view(Conv2d.weight.shape)
-    b_bn = BN2d.bias.data - (BN2d.weight.data * BN2d.running_mean) / bv
-    Conv2d.bias.data = torch.matmul(w_bn, Conv2d.bias.data) + b_bn
-    return Conv2d
+    dtype = Conv2d.weight.dtype
+    ct = torch.promote_types(dtype, torch.float32)
+    conv_bias = torch.zeros_like(BN2d.running_mean) if Conv2d.bias is None else Conv2d.bias.data
+    # computed in (at least) fp32; scale each output channel by broadcasting instead of multiplying with a diagonal matrix
+    w_bn, b_bn = _fuse_bn_channel(BN2d.weight.data.to(ct), BN2d.bias.data.to(ct), BN2d.running_mean.to(ct), BN2d.running_var.to(ct), float(BN2d.eps))
+    bias = torch.addcmul(b_bn, w_bn, conv_bias.to(ct))
+    return _copy_with_new_param(Conv2d, (Conv2d.weight.data.to(ct) * w_bn.view(-1, 1, 1, 1)).to(dtype), bias.to(dtype))
 
 def fuse_BN1d_to_Linear(BN1d, Linear):
-    Linear = copy.deepcopy(Linear)
-    bn_mean, bn_var, bn_weight, bn_bias = BN1d.running_mean.data, BN1d.running_var.data, BN1d.weight.data, BN1d.bias.data
-    W = bn_weight / torch.sqrt(bn_var + BN1d.eps)
-    b = - W * bn_mean + bn_bias
-    W = torch.diag(W)
-    Linear.weight.data = torch.matmul(W, Linear.weight.data)
-    Linear.bias.data = torch.matmul(W, Linear.bias.data) + b
-    return Linear
+    dtype = Linear.weight.dtype
+    ct = torch.promote_types(dtype, torch.float32)
+    linear_bias = torch.zeros_like(BN1d.running_mean) if Linear.bias is None else Linear.bias.data
+    W, b = _fuse_bn_channel(BN1d.weight.data.to(ct), BN1d.bias.data.to(ct), BN1d.running_mean.data.to(ct), BN1d.running_var.data.to(ct), float(BN1d.eps))
+    b = torch.addcmul(b, W, linear_bias.to(ct))
+    return _copy_with_new_param(Linear, (W.unsqueeze(1) * Linear.weight.data.to(ct)).to(dtype), b.to(dtype))
+
+# BN type -> (type of the layer it is fused into, fuse function)
+FUSE_TABLE = {
+    BatchNorm1d: (Linear, fuse_BN1d_to_Linear),
+    BatchNorm2d: (Conv2d, fuse_BN2d_to_Conv2d),
+}
 
 def fuse_BN(net, start_from:int=0):
     '''
@@ -284,22 +434,15 @@ def fuse_BN(net, start_from:int=0):
     '''
     layers = []
     for i, layer in enumerate(net):
-        if i < start_from:
+        spec = FUSE_TABLE.get(type(layer)) if i >= start_from else None
+        if spec is None:
             layers.append(layer)
             continue
-        
-        if isinstance(layer, BatchNorm1d):
-            pr_layer = layers[-1]
-            assert isinstance(pr_layer, Linear), "BN1d should follow a Linear layer."
-            transformed_layer = fuse_BN1d_to_Linear(layer, pr_layer)
-            layers[-1] = transformed_layer
-        elif isinstance(layer, BatchNorm2d):
-            pr_layer = layers[-1]
-            assert isinstance(pr_layer, Conv2d), "BN2d should follow a Conv2d layer."
-            transformed_layer = fuse_BN2d_to_Conv2d(layer, pr_layer)
-            layers[-1] = transformed_layer
-        else:
-            layers.append(layer)
+
+        parent_type, fuse_fn = spec
+        pr_layer = layers[-1]
+        assert isinstance(pr_layer, parent_type), f"{type(layer).__name__} should follow a {parent_type.__name__} layer."
+        layers[-1] = fuse_fn(layer, pr_layer)
     net = Sequential(*layers)
     net.output_dim = layers[-1].output_dim
     return net